@@ -1,25 +1,80 @@
 import os
+from dataclasses import dataclass, field
+from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
+def _env(name: str):
+    """Read an environment variable when Settings is instantiated"""
+    return field(default_factory=lambda: os.getenv(name))
+
+@dataclass(frozen=True, slots=True)
 class Settings:
-    TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-    MINDEE_API_KEY = os.getenv("MINDEE_API_KEY")
-    GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+    TELEGRAM_TOKEN: Optional[str] = _env("TELEGRAM_TOKEN")
+    MINDEE_API_KEY: Optional[str] = _env("MINDEE_API_KEY")
+    GROQ_API_KEY: Optional[str] = _env("GROQ_API_KEY")
+    
+    # Local Bot API server, e.g. http://localhost:8081/bot and http://localhost:8081/file/bot
+    TELEGRAM_BASE_URL: Optional[str] = _env("TELEGRAM_BASE_URL")
+    TELEGRAM_BASE_FILE_URL: Optional[str] = _env("TELEGRAM_BASE_FILE_URL")
+    POLLING_TIMEOUT: int = 30
+    TELEGRAM_POOL_SIZE: int = 256
+    TELEGRAM_POOL_TIMEOUT: float = 10.0
+    TELEGRAM_CONNECT_TIMEOUT: float = 5.0
+    TELEGRAM_READ_TIMEOUT: float = 30.0
+    
+    # Optional Telegram webhook; long polling is used when the URL is not set
+    WEBHOOK_URL: Optional[str] = _env("WEBHOOK_URL")
+    WEBHOOK_SECRET: Optional[str] = _env("WEBHOOK_SECRET")
+    WEBHOOK_LISTEN: str = "0.0.0.0"
+    WEBHOOK_PORT: int = 8443
     
     # File paths
-    DOWNLOADS_DIR = "downloads"
-    MINDEE_DATA_DIR = "mindee_data"
+    MINDEE_DATA_DIR: str = "mindee_data"
+    GROQ_CACHE_DIR: str = "cache/groq"
+    MINDEE_CACHE_DIR: str = "mindee_data/cache"
+    PERSISTENCE_FILE: str = "bot_persistence.pickle"
+    
+    # Conversation settings
+    CONVERSATION_TIMEOUT: int = 30 * 60
+    
+    # HTTP connection pool
+    HTTP_POOL_LIMIT: int = 100
+    HTTP_POOL_LIMIT_PER_HOST: int = 20
+    HTTP_KEEPALIVE_TIMEOUT: int = 60
     
     # API settings
-    MINDEE_MIN_REQUEST_INTERVAL = 3
-    MINDEE_MAX_ATTEMPTS = 10
-    MINDEE_RETRY_DELAY = 3
-    
-    GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
-    GROQ_MODEL = "mixtral-8x7b-32768"
-    GROQ_TEMPERATURE = 0.7
-    GROQ_TIMEOUT = 30
+    MINDEE_QPS: float = 2
+    MINDEE_MAX_CONCURRENCY: int = 4
+    MINDEE_MAX_ATTEMPTS: int = 10
+    MINDEE_RETRY_DELAY: int = 3
+    MINDEE_POLL_INTERVAL: float = 1.0
+    MINDEE_POLL_MAX_DELAY: float = 15.0
+    
+    # Optional Mindee webhook listener; polling is used unless both port and secret are set
+    MINDEE_WEBHOOK_PORT: Optional[str] = _env("MINDEE_WEBHOOK_PORT")
+    MINDEE_WEBHOOK_SECRET: Optional[str] = _env("MINDEE_WEBHOOK_SECRET")
+    MINDEE_WEBHOOK_SIGNATURE_HEADER: str = "X-Mindee-Hmac-Signature"
+    MINDEE_WEBHOOK_HOST: str = "0.0.0.0"
+    MINDEE_WEBHOOK_PATH: str = "/mindee/callback"
+    MINDEE_WEBHOOK_TIMEOUT: float = 60.0
+    MINDEE_WEBHOOK_POLL_INTERVAL: float = 5.0
+    
+    GROQ_API_URL: str = "https://api.groq.com/openai/v1/chat/completions"
+    GROQ_MODEL: str = "mixtral-8x7b-32768"
+    GROQ_TEMPERATURE: float = 0.2
+    GROQ_TIMEOUT: int = 30
+    GROQ_MAX_ATTEMPTS: int = 3
+    GROQ_RETRY_DELAY: float = 0.5
+    GROQ_RPM: int = 30
+    GROQ_BATCH_WINDOW: float = 0.25
+    GROQ_BATCH_MAX_SIZE: int = 8
+    
+    # Cache settings
+    OCR_CACHE_TTL: int = 24 * 60 * 60
+    MINDEE_CACHE_TTL: int = 7 * 24 * 60 * 60
+    POLICY_CACHE_TTL: int = 24 * 60 * 60
+    CACHE_PURGE_INTERVAL: int = 60 * 60
     
 settings = Settings()
\ No newline at end of file
@@ -1,26 +1,235 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import NetworkError
 from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ConversationHandler,
     ContextTypes,
+    TypeHandler,
     filters
 )
-from typing import Optional, Dict
-import uuid
-from datetime import datetime
+from typing import Optional, Dict, Tuple
+import aiohttp
+import asyncio
+import functools
+from collections import defaultdict
+import re
+import time
+from secrets import token_hex
 from config.constants import *
-from services.mindee_service import MindeePassportAPI, MindeeVehicleAPI
-from services.groq_service import GroqService
-from utils.file_utils import ensure_directories_exist, save_mindee_response, generate_policy_filename
+from config.settings import settings
+from services.mindee_service import MindeePassportAPI, MindeeVehicleAPI, MindeeUploadError, MindeeResultError
+from services.groq_service import GroqService, GroqBatcher
+from services.documents import PassportData, VehicleData
+from utils.file_utils import save_mindee_response, generate_policy_filename
 from utils.logging_utils import logger
-import os
+from utils.ocr_cache import get_or_compute
 
 # Ініціалізація сервісів
-mindee_passport_api = MindeePassportAPI()
-mindee_vehicle_api = MindeeVehicleAPI()
-groq_service = GroqService()
+@functools.lru_cache(maxsize=1)
+def get_passport_api() -> MindeePassportAPI:
+    """Клієнт Mindee для паспортів, створюється при першому використанні"""
+    return MindeePassportAPI()
+
+@functools.lru_cache(maxsize=1)
+def get_vehicle_api() -> MindeeVehicleAPI:
+    """Клієнт Mindee для техпаспортів, створюється при першому використанні"""
+    return MindeeVehicleAPI()
+
+@functools.lru_cache(maxsize=1)
+def get_groq_batcher() -> GroqBatcher:
+    """Пакетний генератор полісів Groq, створюється при першому використанні"""
+    return GroqBatcher(GroqService())
+
+# Фонове розпізнавання першої сторінки техпаспорта: user_id -> задача.
+# Зберігається поза user_data, бо задачі не серіалізуються persistence.
+vehicle_page_jobs: Dict[int, asyncio.Task] = {}
+
+# Очікувані збої: мережа або невірне введення - логуються без traceback
+_EXPECTED_ERRORS = (NetworkError, aiohttp.ClientError, asyncio.TimeoutError, ValueError)
+
+def drop_vehicle_page_job(user) -> None:
+    """Скасування фонового розпізнавання першої сторінки техпаспорта користувача"""
+    if user is None:
+        return
+    job = vehicle_page_jobs.pop(user.id, None)
+    if job:
+        job.cancel()
+
+def log_handler_error(handler_name: str, error: Exception):
+    """Логування помилки обробника; викликається з блоку except"""
+    if isinstance(error, _EXPECTED_ERRORS):
+        logger.warning("%s failed: %s", handler_name, error)
+    else:
+        logger.exception("Error in %s", handler_name)
+
+# Останні натискання кнопок: (user_id, callback_data) -> час
+_recent_callbacks: Dict[Tuple[int, str], float] = {}
+
+def dedupe(window: float = 2.0):
+    """Ігнорування повторного натискання тієї ж кнопки протягом window секунд"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
+            query = update.callback_query
+            key = (query.from_user.id, query.data)
+            now = time.monotonic()
+            
+            if now - _recent_callbacks.get(key, float('-inf')) < window:
+                await query.answer("⏳")
+                return None
+            
+            if len(_recent_callbacks) > 1000:
+                for stale_key in [k for k, t in _recent_callbacks.items() if now - t >= window]:
+                    del _recent_callbacks[stale_key]
+            _recent_callbacks[key] = now
+            return await func(update, context)
+        return wrapper
+    return decorator
+
+BACK_RESTART_RE = re.compile(r"^(restart|back_to_)")
+CONFIRM_RE = re.compile(r"^confirm$")
+EDIT_RE = re.compile(r"^edit$")
+CONFIRM_VEHICLE_RE = re.compile(r"^confirm_vehicle$")
+EDIT_VEHICLE_RE = re.compile(r"^edit_vehicle$")
+AGREEMENT_RE = re.compile(r"^(agree|decline)$")
+
+# Ручне введення: непорожні рядки, дати у форматі РРРР-ММ-ДД.
+# Назви груп збігаються з полями PassportData / VehicleData.
+# Пробіли навколо поля - лише горизонтальні, а поле починається й закінчується непробільним
+# символом, тож кожен пробіл належить рівно одній частині шаблону і backtracking лінійний
+_FIELD = r"\S(?:[^\n]*\S)?"
+_SEP = r"[^\S\n]*(?:\n[^\S\n]*)+"
+_DATE = r"\d{4}-\d{2}-\d{2}"
+_PASSPORT_RE = re.compile(
+    rf"\s*(?P<surname>{_FIELD}){_SEP}"
+    rf"(?P<given_name>{_FIELD}){_SEP}"
+    rf"(?P<passport_number>{_FIELD}){_SEP}"
+    rf"(?P<nationality>{_FIELD}){_SEP}"
+    rf"(?P<birth_date>{_DATE})\s*"
+)
+_VEHICLE_RE = re.compile(
+    rf"\s*(?P<vehicle_registration_number>{_FIELD}){_SEP}"
+    rf"(?P<registration_date>{_DATE}){_SEP}"
+    rf"(?P<vehicle_identification_number>{_FIELD}){_SEP}"
+    rf"(?P<make>{_FIELD})\s*"
+)
+# Довші повідомлення відхиляються ще до регулярного виразу
+MAX_MANUAL_INPUT_LENGTH = 512
+
+# Статичні клавіатури
+KB_RESTART_ONLY = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")]
+])
+
+def _back_keyboard(callback_data: str) -> InlineKeyboardMarkup:
+    """Клавіатура з кнопками 'Назад' та 'Почати з початку'"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("↩ Назад", callback_data=callback_data)],
+        [InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")]
+    ])
+
+KB_BACK_TO_PHOTO = _back_keyboard("back_to_photo")
+KB_BACK_TO_PASSPORT_CONFIRM = _back_keyboard("back_to_passport_confirm")
+KB_BACK_TO_PASSPORT_DATA = _back_keyboard("back_to_passport_data")
+KB_BACK_TO_TECH_PASSPORT_1 = _back_keyboard("back_to_tech_passport_1")
+
+KB_CONFIRM = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ Так, все вірно", callback_data="confirm"),
+        InlineKeyboardButton("✏ Виправити вручну", callback_data="edit")
+    ],
+    [
+        InlineKeyboardButton("↩ Назад", callback_data="back_to_photo"),
+        InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")
+    ]
+])
+
+KB_CONFIRM_VEHICLE = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ Так, все вірно", callback_data="confirm_vehicle"),
+        InlineKeyboardButton("✏ Виправити вручну", callback_data="edit_vehicle")
+    ],
+    [
+        InlineKeyboardButton("↩ Назад", callback_data="back_to_tech_passport_2"),
+        InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")
+    ]
+])
+
+KB_AGREEMENT = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ Так, погоджуюсь", callback_data="agree"),
+        InlineKeyboardButton("❌ Відхилити", callback_data="decline")
+    ],
+    [
+        InlineKeyboardButton("↩ Назад", callback_data="back_to_vehicle_confirm"),
+        InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")
+    ]
+])
+
+# Інструкції для ручного введення
+MANUAL_PASSPORT_INSTRUCTIONS = (
+    "📝 Введіть дані паспорта у такому форматі:\n\n"
+    "Прізвище\n"
+    "Ім'я\n"
+    "Номер паспорта\n"
+    "Громадянство\n"
+    "Дата народження (РРРР-ММ-ДД)\n\n"
+    "Приклад:\n"
+    "Іванов\n"
+    "Іван\n"
+    "КМ123456\n"
+    "Україна\n"
+    "1990-05-15"
+)
+
+MANUAL_VEHICLE_INSTRUCTIONS = (
+    "📝 Введіть дані техпаспорта у такому форматі:\n\n"
+    "Номер реєстрації\n"
+    "Дата реєстрації (РРРР-ММ-ДД)\n"
+    "VIN номер\n"
+    "Марка автомобіля\n\n"
+    "Приклад:\n"
+    "АА1234ВВ\n"
+    "2020-01-15\n"
+    "JT2BF22K3W0123456\n"
+    "Toyota Camry"
+)
+
+# Шаблони повідомлень; відсутні поля підставляються через format_map(defaultdict)
+PASSPORT_MSG_TMPL = (
+    "📋 Виявлені дані:\n"
+    "▪ Прізвище: {surname}\n"
+    "▪ Ім'я: {given_name}\n"
+    "▪ Номер паспорта: {passport_number}\n"
+    "▪ Громадянство: {nationality}\n"
+    "▪ Дата народження: {birth_date}\n\n"
+    "Ці дані вірні?"
+)
+
+VEHICLE_MSG_TMPL = (
+    "📋 Виявлені дані техпаспорта:\n"
+    "▪ Номер реєстрації: {vehicle_registration_number}\n"
+    "▪ Дата реєстрації: {registration_date}\n"
+    "▪ Власник: {owner_name}\n"
+    "▪ VIN: {vehicle_identification_number}\n"
+    "▪ Марка: {make}\n\n"
+    "Ці дані вірні?"
+)
+
+AGREEMENT_MSG_TMPL = (
+    "📝 Умови страхування:\n\n"
+    "🚗 Дані автомобіля:\n"
+    "- Номер: {vehicle_registration_number}\n"
+    "- Марка: {make}\n"
+    "- VIN: {vehicle_identification_number}\n\n"
+    "💳 Умови страхування:\n"
+    "1. Вартість: 100 USD на рік\n"
+    "2. Термін дії: 1 рік\n"
+    "3. Покриття: базове\n\n"
+    "Ви погоджуєтесь з умовами?"
+)
 
 # Головні функції бота
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -29,357 +238,253 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await message.reply_text(
         "Привіт! Я бот для створення страховки на ваше авто. "
         "Надішліть фото вашого паспорта для розпізнавання даних.",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")]
-        ])
+        reply_markup=KB_RESTART_ONLY
     )
     return AWAITING_PHOTO
 
+async def download_photo(message) -> bytearray:
+    """Завантаження найбільшого фото з повідомлення в пам'ять, без запису на диск"""
+    photo_file = await message.photo[-1].get_file()
+    # bytearray передається в Mindee та кеш напряму, без додаткової копії в bytes
+    return await photo_file.download_as_bytearray()
+
+async def recognize_passport_photo(img_bytes: bytes) -> Optional[PassportData]:
+    """Розпізнавання паспорта через Mindee: завантаження, очікування результату та розбір"""
+    # Помилки завантаження та очікування передаються обробнику як MindeeUploadError / MindeeResultError
+    mindee_response = await get_passport_api().process_document(img_bytes)
+
+    # Запис JSON на диск виконується в потоці, щоб не блокувати обробку інших користувачів
+    document_id = mindee_response.get('document', {}).get('id') or token_hex(8)
+    await asyncio.to_thread(save_mindee_response, document_id, mindee_response)
+    return get_passport_api().extract_passport_data(mindee_response)
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обробка фото паспорта"""
     try:
-        photo_file = await update.message.photo[-1].get_file()
-        img_path = f"downloads/passport_{uuid.uuid4().hex}.jpg"
-        await photo_file.download_to_drive(img_path)
         await update.message.reply_text("🔍 Розпізнаю дані з фото...")
+        img_bytes = await download_photo(update.message)
 
-        # Відправка на обробку до Mindee
-        job_id = mindee_passport_api.upload_document(img_path)
-        if not job_id:
-            await update.message.reply_text("❌ Не вдалося обробити документ. Спробуйте ще раз.")
-            return await suggest_manual_input(update.message)
-
-        mindee_response = mindee_passport_api.get_result(job_id)
-        if not mindee_response:
-            await update.message.reply_text("⏳ Час очікування вичерпано або виникла помилка.")
-            return await suggest_manual_input(update.message)
-
-        save_mindee_response(job_id, mindee_response)
-        passport_data = mindee_passport_api.extract_passport_data(mindee_response)
+        # Відправка на обробку до Mindee, якщо це фото ще не розпізнавалось
+        recognized = await get_or_compute(
+            img_bytes, 'passport', lambda: recognize_passport_photo(img_bytes)
+        )
         
-        if not passport_data:
+        if not recognized:
             await update.message.reply_text("⚠ Не вдалося розпізнати дані з документу.")
             return await suggest_manual_input(update.message)
 
+        passport_data = PassportData(**recognized)
         context.user_data['passport_data'] = passport_data
         return await show_data_for_confirmation(update.message, passport_data)
 
+    except MindeeUploadError:
+        await update.message.reply_text("❌ Не вдалося обробити документ. Спробуйте ще раз.")
+        return await suggest_manual_input(update.message)
+    except MindeeResultError:
+        await update.message.reply_text("⏳ Час очікування вичерпано або виникла помилка.")
+        return await suggest_manual_input(update.message)
     except Exception as e:
-        logger.error(f"Error in handle_photo: {e}", exc_info=True)
+        log_handler_error("handle_photo", e)
         await update.message.reply_text("❌ Сталася несподівана помилка. Спробуйте ще раз.")
         return AWAITING_PHOTO
 
 async def suggest_manual_input(message) -> int:
     """Запит на ручне введення даних паспорта"""
-    instructions = (
-        "📝 Введіть дані паспорта у такому форматі:\n\n"
-        "Прізвище\n"
-        "Ім'я\n"
-        "Номер паспорта\n"
-        "Громадянство\n"
-        "Дата народження (РРРР-ММ-ДД)\n\n"
-        "Приклад:\n"
-        "Іванов\n"
-        "Іван\n"
-        "КМ123456\n"
-        "Україна\n"
-        "1990-05-15"
-    )
-    keyboard = [
-        [InlineKeyboardButton("↩ Назад", callback_data="back_to_photo")],
-        [InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")]
-    ]
-    await message.reply_text(instructions, reply_markup=InlineKeyboardMarkup(keyboard))
+    await message.reply_text(MANUAL_PASSPORT_INSTRUCTIONS, reply_markup=KB_BACK_TO_PHOTO)
     return AWAITING_MANUAL_DATA
 
-async def show_data_for_confirmation(message, data: dict) -> int:
+async def show_data_for_confirmation(message, data: PassportData) -> int:
     """Підтвердження даних паспорта"""
-    msg = (
-        "📋 Виявлені дані:\n"
-        f"▪ Прізвище: {data['surname']}\n"
-        f"▪ Ім'я: {data['given_name']}\n"
-        f"▪ Номер паспорта: {data['document_number']}\n"
-        f"▪ Громадянство: {data['nationality']}\n"
-        f"▪ Дата народження: {data['birth_date']}\n\n"
-        "Ці дані вірні?"
-    )
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Так, все вірно", callback_data="confirm"),
-            InlineKeyboardButton("✏ Виправити вручну", callback_data="edit")
-        ],
-        [
-            InlineKeyboardButton("↩ Назад", callback_data="back_to_photo"),
-            InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")
-        ]
-    ]
-    await message.reply_text(msg, reply_markup=InlineKeyboardMarkup(keyboard))
+    msg = PASSPORT_MSG_TMPL.format_map(defaultdict(lambda: 'Не вказано', data.filled()))
+    await message.reply_text(msg, reply_markup=KB_CONFIRM)
     return AWAITING_CONFIRM
 
+@dedupe(window=2.0)
 async def confirm_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Підтвердження даних паспорта"""
     query = update.callback_query
     await query.answer()
     
-    keyboard = [
-        [InlineKeyboardButton("↩ Назад", callback_data="back_to_passport_confirm")],
-        [InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")]
-    ]
-    
     await query.edit_message_text(
         "✅ Дані паспорта підтверджено!\n\n"
         "Тепер будь ласка, надішліть фото першої сторінки техпаспорта (де вказаний номер реєстрації):",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=KB_BACK_TO_PASSPORT_CONFIRM
     )
     return AWAITING_TECH_PASSPORT_1
 
+@dedupe(window=2.0)
 async def edit_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Редагування даних паспорта"""
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("✏ Будь ласка, введіть дані паспорта вручну:")
-    return await suggest_manual_input(query.message)
+    # Інструкції показуються в тому ж повідомленні - без окремого запиту до Telegram
+    await query.edit_message_text(MANUAL_PASSPORT_INSTRUCTIONS, reply_markup=KB_BACK_TO_PHOTO)
+    return AWAITING_MANUAL_DATA
 
 async def handle_manual_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обробка ручного введення даних паспорта"""
     try:
-        parts = [line.strip() for line in update.message.text.split('\n') if line.strip()]
-        if len(parts) != 5:
+        text = update.message.text
+        match = _PASSPORT_RE.fullmatch(text) if len(text) <= MAX_MANUAL_INPUT_LENGTH else None
+        if not match:
             raise ValueError("Потрібно ввести рівно 5 рядків з даними паспорта")
             
-        context.user_data['passport_data'] = {
-            'surname': parts[0],
-            'given_name': parts[1],
-            'passport_number': parts[2],
-            'nationality': parts[3],
-            'birth_date': parts[4],
-            'tech_passport': None
-        }
-        
-        keyboard = [
-            [InlineKeyboardButton("↩ Назад", callback_data="back_to_passport_confirm")],
-            [InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")]
-        ]
+        context.user_data['passport_data'] = PassportData(**match.groupdict())
         
         await update.message.reply_text(
             "✅ Дані паспорта збережено!\n\n"
             "Тепер будь ласка, надішліть фото першої сторінки техпаспорта (де вказаний номер реєстрації):",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=KB_BACK_TO_PASSPORT_CONFIRM
         )
         return AWAITING_TECH_PASSPORT_1
         
     except Exception as e:
-        logger.error(f"Error in handle_manual_data: {e}")
+        log_handler_error("handle_manual_data", e)
         await update.message.reply_text("❌ Невірний формат даних. Будь ласка, введіть дані у вказаному форматі.")
         return AWAITING_MANUAL_DATA
 
+async def recognize_vehicle_photo(img_bytes: bytes) -> Optional[VehicleData]:
+    """Розпізнавання сторінки техпаспорта через Mindee: завантаження, очікування результату та розбір"""
+    mindee_response = await get_vehicle_api().process_document(img_bytes)
+    return get_vehicle_api().extract_vehicle_data(mindee_response)
+
+async def recognize_vehicle_page(img_bytes: bytes) -> Optional[Dict]:
+    """Розпізнавання сторінки техпаспорта з використанням кешу OCR"""
+    return await get_or_compute(img_bytes, 'vehicle', lambda: recognize_vehicle_photo(img_bytes))
+
+async def recognize_stored_page(bot, file_id: str) -> Optional[Dict]:
+    """Повторне завантаження та розпізнавання сторінки за file_id Telegram"""
+    photo_file = await bot.get_file(file_id)
+    return await recognize_vehicle_page(await photo_file.download_as_bytearray())
+
 async def handle_tech_passport_1(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обробка першої сторінки техпаспорта"""
     try:
-        photo_file = await update.message.photo[-1].get_file()
-        img_path = f"downloads/tech_passport_1_{uuid.uuid4().hex}.jpg"
-        await photo_file.download_to_drive(img_path)
-        
-        await update.message.reply_text("🔍 Обробляю першу сторінку техпаспорта...")
-        
-        job_id = mindee_vehicle_api.upload_document(img_path)
-        if not job_id:
-            await update.message.reply_text("❌ Не вдалося обробити техпаспорт. Спробуйте ще раз.")
-            return AWAITING_TECH_PASSPORT_1
-
-        mindee_response = mindee_vehicle_api.get_result(job_id)
-        if not mindee_response:
-            await update.message.reply_text("⏳ Час очікування вичерпано або виникла помилка.")
-            return await suggest_manual_vehicle_input(update.message)
-
-        vehicle_data = mindee_vehicle_api.extract_vehicle_data(mindee_response)
-        
-        if not vehicle_data:
-            await update.message.reply_text("⚠ Не вдалося розпізнати дані з техпаспорта.")
-            return await suggest_manual_vehicle_input(update.message)
+        img_bytes = await download_photo(update.message)
 
-        context.user_data['vehicle_data'] = vehicle_data
-        
-        keyboard = [
-            [InlineKeyboardButton("↩ Назад", callback_data="back_to_passport_data")],
-            [InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")]
-        ]
+        # Розпізнавання першої сторінки триває у фоні, поки користувач надсилає другу
+        drop_vehicle_page_job(update.effective_user)
+        vehicle_page_jobs[update.effective_user.id] = asyncio.create_task(recognize_vehicle_page(img_bytes))
+        # file_id зберігається в persistence, тож першу сторінку можна отримати й після перезапуску
+        context.user_data['tech_passport_1_file_id'] = update.message.photo[-1].file_id
         
         await update.message.reply_text(
-            "✅ Перша сторінка оброблена!\n\n"
+            "✅ Першу сторінку прийнято!\n\n"
             "Тепер будь ласка, надішліть фото другої сторінки техпаспорта (де вказані марка та VIN):",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=KB_BACK_TO_PASSPORT_DATA
         )
         return AWAITING_TECH_PASSPORT_2
         
     except Exception as e:
-        logger.error(f"Error in handle_tech_passport_1: {e}")
+        log_handler_error("handle_tech_passport_1", e)
         await update.message.reply_text("❌ Помилка при обробці техпаспорта. Спробуйте ще раз.")
         return AWAITING_TECH_PASSPORT_1
 
 async def handle_tech_passport_2(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обробка другої сторінки техпаспорта"""
     try:
-        photo_file = await update.message.photo[-1].get_file()
-        img_path = f"downloads/tech_passport_2_{uuid.uuid4().hex}.jpg"
-        await photo_file.download_to_drive(img_path)
-        
-        await update.message.reply_text("🔍 Обробляю другу сторінку техпаспорта...")
+        img_bytes = await download_photo(update.message)
         
-        job_id = mindee_vehicle_api.upload_document(img_path)
-        if not job_id:
-            await update.message.reply_text("❌ Не вдалося обробити техпаспорт. Спробуйте ще раз.")
-            return AWAITING_TECH_PASSPORT_2
-
-        mindee_response = mindee_vehicle_api.get_result(job_id)
-        if not mindee_response:
-            await update.message.reply_text("⏳ Час очікування вичерпано або виникла помилка.")
-            return await suggest_manual_vehicle_input(update.message)
-
-        additional_data = mindee_vehicle_api.extract_vehicle_data(mindee_response)
+        await update.message.reply_text("🔍 Обробляю сторінки техпаспорта...")
+
+        # Обидві сторінки опитуються одночасно
+        first_page_job = vehicle_page_jobs.pop(update.effective_user.id, None)
+        if first_page_job is None and context.user_data.get('tech_passport_1_file_id'):
+            # Фонова задача втрачена (перезапуск бота) - розпізнаємо першу сторінку заново
+            first_page_job = recognize_stored_page(context.bot, context.user_data['tech_passport_1_file_id'])
+        if first_page_job:
+            first_page, second_page = await asyncio.gather(
+                first_page_job,
+                recognize_vehicle_page(img_bytes)
+            )
+            vehicle_data = VehicleData(**first_page) if first_page else None
+        else:
+            vehicle_data = context.user_data.get('vehicle_data')
+            second_page = await recognize_vehicle_page(img_bytes)
         
-        if not additional_data:
+        if not vehicle_data or not second_page:
             await update.message.reply_text("⚠ Не вдалося розпізнати дані з техпаспорта.")
             return await suggest_manual_vehicle_input(update.message)
 
-        vehicle_data = context.user_data.get('vehicle_data', {})
-        vehicle_data.update(additional_data)
+        vehicle_data = vehicle_data.merged(VehicleData(**second_page))
         context.user_data['vehicle_data'] = vehicle_data
         
-        if not vehicle_data.get('owner_name'):
-            passport_data = context.user_data.get('passport_data', {})
-            owner_name = f"{passport_data.get('given_name', '')} {passport_data.get('surname', '')}".strip()
-            if owner_name:
-                vehicle_data['owner_name'] = owner_name
+        if not vehicle_data.owner_name:
+            passport_data = context.user_data.get('passport_data') or PassportData()
+            vehicle_data.owner_name = passport_data.full_name
         
         return await show_vehicle_data_for_confirmation(update.message, vehicle_data)
         
+    except MindeeUploadError:
+        await update.message.reply_text("❌ Не вдалося обробити техпаспорт. Спробуйте ще раз.")
+        return await suggest_manual_vehicle_input(update.message)
+    except MindeeResultError:
+        await update.message.reply_text("⏳ Час очікування вичерпано або виникла помилка.")
+        return await suggest_manual_vehicle_input(update.message)
     except Exception as e:
-        logger.error(f"Error in handle_tech_passport_2: {e}")
+        log_handler_error("handle_tech_passport_2", e)
         await update.message.reply_text("❌ Помилка при обробці техпаспорта. Спробуйте ще раз.")
         return AWAITING_TECH_PASSPORT_2
 
 async def suggest_manual_vehicle_input(message) -> int:
     """Запит на ручне введення даних техпаспорта"""
-    instructions = (
-        "📝 Введіть дані техпаспорта у такому форматі:\n\n"
-        "Номер реєстрації\n"
-        "Дата реєстрації (РРРР-ММ-ДД)\n"
-        "VIN номер\n"
-        "Марка автомобіля\n\n"
-        "Приклад:\n"
-        "АА1234ВВ\n"
-        "2020-01-15\n"
-        "JT2BF22K3W0123456\n"
-        "Toyota Camry"
-    )
-    keyboard = [
-        [InlineKeyboardButton("↩ Назад", callback_data="back_to_tech_passport_1")],
-        [InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")]
-    ]
-    await message.reply_text(instructions, reply_markup=InlineKeyboardMarkup(keyboard))
+    await message.reply_text(MANUAL_VEHICLE_INSTRUCTIONS, reply_markup=KB_BACK_TO_TECH_PASSPORT_1)
     return AWAITING_MANUAL_VEHICLE_DATA
 
 async def handle_manual_vehicle_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обробка ручного введення даних техпаспорта"""
     try:
-        parts = [line.strip() for line in update.message.text.split('\n') if line.strip()]
-        if len(parts) != 4:
+        text = update.message.text
+        match = _VEHICLE_RE.fullmatch(text) if len(text) <= MAX_MANUAL_INPUT_LENGTH else None
+        if not match:
             raise ValueError("Потрібно ввести рівно 4 рядки з даними техпаспорта")
             
-        context.user_data['vehicle_data'] = {
-            'vehicle_registration_number': parts[0],
-            'registration_date': parts[1],
-            'vehicle_identification_number': parts[2],
-            'make': parts[3],
-            'owner_name': context.user_data['passport_data'].get('given_name', '') + ' ' + 
-                         context.user_data['passport_data'].get('surname', ''),
-            'insurance_details': []
-        }
+        context.user_data['vehicle_data'] = VehicleData(
+            **match.groupdict(),
+            owner_name=context.user_data['passport_data'].full_name
+        )
         
         return await show_vehicle_data_for_confirmation(update.message, context.user_data['vehicle_data'])
         
     except Exception as e:
-        logger.error(f"Error in handle_manual_vehicle_data: {e}")
+        log_handler_error("handle_manual_vehicle_data", e)
         await update.message.reply_text("❌ Невірний формат даних. Будь ласка, введіть дані у вказаному форматі.")
         return AWAITING_MANUAL_VEHICLE_DATA
 
-async def show_vehicle_data_for_confirmation(message, data: dict) -> int:
+async def show_vehicle_data_for_confirmation(message, data: VehicleData) -> int:
     """Підтвердження даних техпаспорта"""
-    data.setdefault('vehicle_registration_number', 'Не вказано')
-    data.setdefault('registration_date', 'Не вказано')
-    data.setdefault('owner_name', 'Не вказано')
-    data.setdefault('vehicle_identification_number', 'Не вказано')
-    data.setdefault('make', 'Не вказано')
-    
-    msg = (
-        "📋 Виявлені дані техпаспорта:\n"
-        f"▪ Номер реєстрації: {data['vehicle_registration_number']}\n"
-        f"▪ Дата реєстрації: {data['registration_date']}\n"
-        f"▪ Власник: {data['owner_name']}\n"
-        f"▪ VIN: {data['vehicle_identification_number']}\n"
-        f"▪ Марка: {data['make']}\n\n"
-        "Ці дані вірні?"
-    )
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Так, все вірно", callback_data="confirm_vehicle"),
-            InlineKeyboardButton("✏ Виправити вручну", callback_data="edit_vehicle")
-        ],
-        [
-            InlineKeyboardButton("↩ Назад", callback_data="back_to_tech_passport_2"),
-            InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")
-        ]
-    ]
-    await message.reply_text(msg, reply_markup=InlineKeyboardMarkup(keyboard))
+    # Значення за замовчуванням не записуються у user_data
+    msg = VEHICLE_MSG_TMPL.format_map(defaultdict(lambda: 'Не вказано', data.filled()))
+    await message.reply_text(msg, reply_markup=KB_CONFIRM_VEHICLE)
     return AWAITING_VEHICLE_CONFIRM
 
+@dedupe(window=2.0)
 async def confirm_vehicle_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Підтвердження даних техпаспорта"""
     query = update.callback_query
     await query.answer()
     
-    vehicle_data = context.user_data.get('vehicle_data', {})
-    context.user_data['passport_data']['tech_passport'] = vehicle_data.get('vehicle_registration_number', '')
+    vehicle_data = context.user_data.get('vehicle_data') or VehicleData()
+    context.user_data['passport_data'].tech_passport = vehicle_data.vehicle_registration_number
     
-    return await show_agreement(query.message, context.user_data)
+    return await show_agreement(query, context.user_data)
 
+@dedupe(window=2.0)
 async def edit_vehicle_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Редагування даних техпаспорта"""
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("✏ Будь ласка, введіть дані техпаспорта вручну:")
+    await query.edit_message_text(MANUAL_VEHICLE_INSTRUCTIONS, reply_markup=KB_BACK_TO_TECH_PASSPORT_1)
     return AWAITING_MANUAL_VEHICLE_DATA
 
-async def show_agreement(message, data: dict) -> int:
-    """Відображення умов страхування"""
-    vehicle_data = data.get('vehicle_data', {})
-    
-    msg = (
-        "📝 Умови страхування:\n\n"
-        f"🚗 Дані автомобіля:\n"
-        f"- Номер: {vehicle_data.get('vehicle_registration_number', 'Невідомо')}\n"
-        f"- Марка: {vehicle_data.get('make', 'Невідомо')}\n"
-        f"- VIN: {vehicle_data.get('vehicle_identification_number', 'Невідомо')}\n\n"
-        "💳 Умови страхування:\n"
-        "1. Вартість: 100 USD на рік\n"
-        "2. Термін дії: 1 рік\n"
-        "3. Покриття: базове\n\n"
-        "Ви погоджуєтесь з умовами?"
-    )
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Так, погоджуюсь", callback_data="agree"),
-            InlineKeyboardButton("❌ Відхилити", callback_data="decline")
-        ],
-        [
-            InlineKeyboardButton("↩ Назад", callback_data="back_to_vehicle_confirm"),
-            InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")
-        ]
-    ]
-    await message.reply_text(msg, reply_markup=InlineKeyboardMarkup(keyboard))
+async def show_agreement(query, data: dict) -> int:
+    """Відображення умов страхування замість повідомлення з підтвердженням"""
+    vehicle_data = data.get('vehicle_data') or VehicleData()
+    msg = AGREEMENT_MSG_TMPL.format_map(defaultdict(lambda: 'Невідомо', vehicle_data.filled()))
+    await query.edit_message_text(msg, reply_markup=KB_AGREEMENT)
     return AWAITING_AGREEMENT
 
+@dedupe(window=2.0)
 async def handle_agreement(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обробка відповіді на умови страхування"""
     query = update.callback_query
@@ -387,74 +492,97 @@ async def handle_agreement(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     if query.data == "decline":
         await query.edit_message_text("Добре, якщо передумаєте — я тут! Просто напишіть /start.")
-        keyboard = [[InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")]]
         return ConversationHandler.END
 
     elif query.data == "agree":
         await query.edit_message_text("🔄 Генерую страховий поліс...")
         
-        policy_text = await groq_service.generate_insurance_policy(context.user_data)
-        passport_data = context.user_data.get('passport_data', {})
-        txt_path = generate_policy_filename(passport_data)
-        
-        with open(txt_path, "w", encoding="utf-8") as f:
-            f.write(policy_text)
+        policy_text = await get_groq_batcher().generate_insurance_policy(context.user_data)
+        passport_data = context.user_data.get('passport_data') or PassportData()
 
         await query.edit_message_text("✅ Ваш страховий поліс сформовано:")
         
-        with open(txt_path, "rb") as f:
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=f,
-                filename=f"Страховий_поліс_{passport_data.get('given_name', '')}_{passport_data.get('surname', '')}.txt",
-                caption="Ваш страховий поліс у форматі TXT"
-            )
-        
-        os.remove(txt_path)
+        # Поліс надсилається з пам'яті, без тимчасового файлу на диску
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=policy_text.encode("utf-8"),
+            filename=generate_policy_filename(passport_data),
+            caption="Ваш страховий поліс у форматі TXT"
+        )
         
         return ConversationHandler.END
 
-async def handle_back_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def _go_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.callback_query.edit_message_text("Надішліть фото вашого паспорта для розпізнавання даних.")
+    return AWAITING_PHOTO
+
+async def _go_passport_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    return await show_data_for_confirmation(update.callback_query.message, context.user_data.get('passport_data') or PassportData())
+
+async def _go_tech_passport_1(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.callback_query.edit_message_text(
+        "Будь ласка, надішліть фото першої сторінки техпаспорта (де вказаний номер реєстрації):"
+    )
+    return AWAITING_TECH_PASSPORT_1
+
+async def _go_tech_passport_2(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.callback_query.edit_message_text(
+        "Будь ласка, надішліть фото другої сторінки техпаспорта (де вказані марка та VIN):"
+    )
+    return AWAITING_TECH_PASSPORT_2
+
+async def _go_vehicle_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    return await show_vehicle_data_for_confirmation(update.callback_query.message, context.user_data.get('vehicle_data') or VehicleData())
+
+async def _restart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data.clear()
+    drop_vehicle_page_job(update.effective_user)
+    await update.callback_query.edit_message_text("Починаємо з початку...")
+    return await start(update, context)
+
+_BACK_DISPATCH = {
+    "back_to_photo": _go_photo,
+    "back_to_passport_confirm": _go_passport_confirm,
+    "back_to_tech_passport_1": _go_tech_passport_1,
+    "back_to_tech_passport_2": _go_tech_passport_2,
+    "back_to_vehicle_confirm": _go_vehicle_confirm,
+    "back_to_passport_data": _go_passport_confirm,
+    "restart": _restart,
+}
+
+async def handle_back_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
     """Обробка кнопок 'Назад'"""
     query = update.callback_query
     await query.answer()
     
-    if query.data == "back_to_photo":
-        await query.edit_message_text("Надішліть фото вашого паспорта для розпізнавання даних.")
-        return AWAITING_PHOTO
-        
-    elif query.data == "back_to_passport_confirm":
-        return await show_data_for_confirmation(query.message, context.user_data.get('passport_data', {}))
-        
-    elif query.data == "back_to_tech_passport_1":
-        await query.edit_message_text(
-            "Будь ласка, надішліть фото першої сторінки техпаспорта (де вказаний номер реєстрації):"
-        )
-        return AWAITING_TECH_PASSPORT_1
-        
-    elif query.data == "back_to_tech_passport_2":
-        await query.edit_message_text(
-            "Будь ласка, надішліть фото другої сторінки техпаспорта (де вказані марка та VIN):"
+    handler = _BACK_DISPATCH.get(query.data)
+    if handler:
+        return await handler(update, context)
+    return None
+
+async def handle_waiting(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Відповідь на дії користувача, поки триває обробка попереднього запиту"""
+    if update.callback_query:
+        await update.callback_query.answer("⏳ Зачекайте, обробка ще триває...")
+    elif update.message:
+        await update.message.reply_text("⏳ Зачекайте, обробка ще триває...")
+
+async def handle_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Завершення розмови після тривалої неактивності"""
+    context.user_data.clear()
+    drop_vehicle_page_job(update.effective_user)
+    if update.effective_chat:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="⌛ Сесію завершено через неактивність. Напишіть /start, щоб почати знову."
         )
-        return AWAITING_TECH_PASSPORT_2
-        
-    elif query.data == "back_to_vehicle_confirm":
-        return await show_vehicle_data_for_confirmation(query.message, context.user_data.get('vehicle_data', {}))
-        
-    elif query.data == "back_to_passport_data":
-        return await show_data_for_confirmation(query.message, context.user_data.get('passport_data', {}))
-        
-    elif query.data == "restart":
-        context.user_data.clear()
-        await query.edit_message_text("Починаємо з початку...")
-        return await start(update, context)
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Скасування розмови"""
-    keyboard = [[InlineKeyboardButton("🔄 Почати з початку", callback_data="restart")]]
+    drop_vehicle_page_job(update.effective_user)
     await update.message.reply_text(
         "❌ Операцію скасовано.",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=KB_RESTART_ONLY
     )
     return ConversationHandler.END
 
@@ -464,48 +592,47 @@ def get_conversation_handler():
         entry_points=[CommandHandler('start', start)],
         states={
             AWAITING_PHOTO: [
-                MessageHandler(filters.PHOTO, handle_photo),
-                CallbackQueryHandler(handle_back_button, pattern="^(restart|back_to_)"),
-                CommandHandler('cancel', cancel)
+                MessageHandler(filters.PHOTO, handle_photo, block=False)
             ],
             AWAITING_CONFIRM: [
-                CallbackQueryHandler(confirm_data, pattern='^confirm$'),
-                CallbackQueryHandler(edit_data, pattern='^edit$'),
-                CallbackQueryHandler(handle_back_button, pattern="^(restart|back_to_)"),
-                CommandHandler('cancel', cancel)
+                CallbackQueryHandler(confirm_data, pattern=CONFIRM_RE),
+                CallbackQueryHandler(edit_data, pattern=EDIT_RE)
             ],
             AWAITING_MANUAL_DATA: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_manual_data),
-                CallbackQueryHandler(handle_back_button, pattern="^(restart|back_to_)"),
-                CommandHandler('cancel', cancel)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_manual_data)
             ],
             AWAITING_TECH_PASSPORT_1: [
-                MessageHandler(filters.PHOTO, handle_tech_passport_1),
-                CallbackQueryHandler(handle_back_button, pattern="^(restart|back_to_)"),
-                CommandHandler('cancel', cancel)
+                MessageHandler(filters.PHOTO, handle_tech_passport_1)
             ],
             AWAITING_TECH_PASSPORT_2: [
-                MessageHandler(filters.PHOTO, handle_tech_passport_2),
-                CallbackQueryHandler(handle_back_button, pattern="^(restart|back_to_)"),
-                CommandHandler('cancel', cancel)
+                MessageHandler(filters.PHOTO, handle_tech_passport_2, block=False)
             ],
             AWAITING_MANUAL_VEHICLE_DATA: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_manual_vehicle_data),
-                CallbackQueryHandler(handle_back_button, pattern="^(restart|back_to_)"),
-                CommandHandler('cancel', cancel)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_manual_vehicle_data)
             ],
             AWAITING_VEHICLE_CONFIRM: [
-                CallbackQueryHandler(confirm_vehicle_data, pattern='^confirm_vehicle$'),
-                CallbackQueryHandler(edit_vehicle_data, pattern='^edit_vehicle$'),
-                CallbackQueryHandler(handle_back_button, pattern="^(restart|back_to_)"),
-                CommandHandler('cancel', cancel)
+                CallbackQueryHandler(confirm_vehicle_data, pattern=CONFIRM_VEHICLE_RE),
+                CallbackQueryHandler(edit_vehicle_data, pattern=EDIT_VEHICLE_RE)
             ],
             AWAITING_AGREEMENT: [
-                CallbackQueryHandler(handle_agreement, pattern='^(agree|decline)$'),
-                CallbackQueryHandler(handle_back_button, pattern="^(restart|back_to_)"),
-                CommandHandler('cancel', cancel)
+                CallbackQueryHandler(handle_agreement, pattern=AGREEMENT_RE, block=False)
+            ],
+            # Розпізнавання фото, техпаспорта та генерація поліса виконуються у фоні
+            ConversationHandler.WAITING: [
+                MessageHandler(filters.ALL, handle_waiting),
+                CallbackQueryHandler(handle_waiting)
+            ],
+            ConversationHandler.TIMEOUT: [
+                TypeHandler(Update, handle_timeout)
             ],
         },
-        fallbacks=[CommandHandler('cancel', cancel)],
-        allow_reentry=True
+        # Кнопки "Назад"/"Почати з початку" та /cancel спільні для всіх станів
+        fallbacks=[
+            CallbackQueryHandler(handle_back_button, pattern=BACK_RESTART_RE),
+            CommandHandler('cancel', cancel)
+        ],
+        allow_reentry=True,
+        conversation_timeout=settings.CONVERSATION_TIMEOUT,
+        name="insurance_conversation",
+        persistent=True
     )
\ No newline at end of file
@@ -0,0 +1,37 @@
+from dataclasses import dataclass, asdict, replace
+from typing import Dict, Optional
+
+@dataclass(slots=True)
+class PassportData:
+    """Passport fields collected from OCR or manual input"""
+    surname: str = ""
+    given_name: str = ""
+    passport_number: str = ""
+    nationality: str = ""
+    birth_date: str = ""
+    tech_passport: Optional[str] = None
+
+    @property
+    def full_name(self) -> str:
+        return f"{self.given_name} {self.surname}".strip()
+
+    def filled(self) -> Dict:
+        """Return only the fields that have a value"""
+        return {key: value for key, value in asdict(self).items() if value}
+
+@dataclass(slots=True)
+class VehicleData:
+    """Vehicle registration fields collected from OCR or manual input"""
+    vehicle_registration_number: str = ""
+    registration_date: str = ""
+    owner_name: str = ""
+    vehicle_identification_number: str = ""
+    make: str = ""
+
+    def merged(self, other: "VehicleData") -> "VehicleData":
+        """Return a copy updated with the non-empty fields of another page"""
+        return replace(self, **other.filled())
+
+    def filled(self) -> Dict:
+        """Return only the fields that have a value"""
+        return {key: value for key, value in asdict(self).items() if value}
@@ -1,12 +1,90 @@
-import requests
+import aiohttp
+import asyncio
 import logging
-import uuid
+import orjson
 from datetime import datetime
-from typing import Optional, Dict
+from secrets import token_hex
+from collections import ChainMap
+from dataclasses import asdict
+from typing import Optional, Dict, List, Set, Tuple
 from config.settings import settings
+from utils.http_utils import get_session
+from utils.rate_limit import groq_bucket
+from utils.policy_cache import load_policy, store_policy
 
 logger = logging.getLogger(__name__)
 
+POLICY_SYSTEM_PROMPT = (
+    "Ти - асистент з оформлення страхової документації. "
+    "Створюй офіційні, професійні тексти страхових полісів українською мовою. "
+    "Використовуй стандартні формулювання та юридично коректні терміни. "
+    "Включи всі обов'язкові реквізити страхового поліса."
+)
+
+# Незмінний початок запиту: однаковий префікс для всіх користувачів
+# дозволяє провайдеру перевикористати кеш промпту, тому змінні дані йдуть лише після нього
+POLICY_PROMPT_PREFIX = (
+    "Створи офіційний текст страхового поліса українською мовою. "
+    "Додай стандартні пункти страхового поліса, підпис та печатку. "
+    "Умови страхування: базове покриття, термін дії 1 рік, вартість 100 USD.\n"
+    "Дані поліса:\n"
+)
+
+POLICY_BATCH_PROMPT_PREFIX = (
+    "Створи окремі офіційні тексти страхових полісів українською мовою, "
+    "по одному для кожного страхувальника. "
+    "До кожного поліса додай стандартні пункти страхового поліса, підпис та печатку. "
+    "Умови страхування: базове покриття, термін дії 1 рік, вартість 100 USD. "
+    "Поверни лише JSON-масив рядків з текстами полісів у тому ж порядку, без іншого тексту.\n"
+)
+
+# Шаблон даних поліса; поля беруться з номера/дати поліса, паспорта та техпаспорта
+POLICY_DETAILS_TEMPLATE = (
+    "1. Номер поліса: {policy_number}\n"
+    "2. Дата оформлення: {current_date}\n"
+    "3. Страхувальник: {given_name} {surname}\n"
+    "4. Паспорт: {passport_number}\n"
+    "5. Дата народження: {birth_date}\n"
+    "6. Автомобіль: {make}\n"
+    "7. Номерний знак: {vehicle_registration_number}\n"
+    "8. VIN: {vehicle_identification_number}\n"
+    "9. Дата реєстрації ТЗ: {registration_date}\n"
+)
+
+# Поліс, що видається без Groq, якщо API недоступне
+FALLBACK_POLICY_TEMPLATE = (
+    "СТРАХОВИЙ ПОЛІС №{policy_number}\n\n"
+    "Дата оформлення: {current_date}\n\n"
+    "Страхувальник:\n"
+    "ПІБ: {given_name} {surname}\n"
+    "Паспорт: {passport_number}\n"
+    "Дата народження: {birth_date}\n\n"
+    "Об'єкт страхування:\n"
+    "Марка: {make}\n"
+    "Номерний знак: {vehicle_registration_number}\n"
+    "VIN: {vehicle_identification_number}\n"
+    "Дата реєстрації: {registration_date}\n\n"
+    "Умови страхування:\n"
+    "- Вид: Автоцивілка (ОСЦПВ)\n"
+    "- Термін дії: 1 рік\n"
+    "- Сума: 100 USD\n"
+    "- Територія: Україна\n\n"
+    "Особливі умови:\n"
+    "Страхувальник зобов'язаний повідомляти про будь-які зміни.\n\n"
+    "Дата: {current_date}\n"
+    "Підпис: ___________\n"
+    "Печатка: ___________"
+)
+
+class _PolicyFields(ChainMap):
+    """ChainMap that renders missing template fields as empty strings"""
+    
+    def __missing__(self, key):
+        return ''
+
+class GroqContextLengthError(Exception):
+    """Raised when a prompt exceeds the model's context or token limit"""
+
 class GroqService:
     """Service for interacting with Groq API"""
     
@@ -18,92 +96,286 @@ class GroqService:
         }
     
     async def chat_completion(self, system: str, user: str) -> Optional[str]:
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user}
+        ]
+        reprompted = False
+        
+        # Повторна підказка після некоректної відповіді не витрачає спроби, відведені на мережеві збої
+        attempt = 0
+        while attempt < settings.GROQ_MAX_ATTEMPTS:
+            try:
+                result = await self._request_completion(messages)
+            except GroqContextLengthError:
+                # Повтор того ж запиту не допоможе, рішення приймає викликач
+                raise
+            except aiohttp.ClientResponseError as e:
+                # Помилки клієнта (крім 429) повтор не виправить
+                if e.status < 500 and e.status != 429:
+                    logger.error(f"Groq API error: {str(e)}")
+                    return None
+                logger.warning(f"Groq API attempt {attempt + 1} failed: {str(e)}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Groq API attempt {attempt + 1} failed: {str(e)}")
+            except Exception as e:
+                logger.error(f"Groq API error: {str(e)}")
+                return None
+            else:
+                content, error = self._extract_content(result)
+                if content:
+                    return content
+                if reprompted:
+                    logger.error(f"Groq API returned invalid response: {error}")
+                    return None
+                
+                # Одна повторна спроба з описом помилки в діалозі
+                logger.warning(f"Groq API returned invalid response, re-prompting: {error}")
+                reprompted = True
+                messages = messages + [{
+                    "role": "user",
+                    "content": f"Попередня відповідь некоректна ({error}). Надішли повну відповідь ще раз."
+                }]
+                continue
+            
+            if attempt < settings.GROQ_MAX_ATTEMPTS - 1:
+                await asyncio.sleep(settings.GROQ_RETRY_DELAY * 2 ** attempt)
+            attempt += 1
+        
+        return None
+    
+    async def _request_completion(self, messages: List[Dict]) -> Dict:
+        """Send one chat completion request and return the decoded body"""
         data = {
             "model": settings.GROQ_MODEL,
-            "messages": [
-                {"role": "system", "content": system},
-                {"role": "user", "content": user}
-            ],
+            "messages": messages,
             "temperature": settings.GROQ_TEMPERATURE
         }
         
-        try:
-            response = requests.post(
-                self.api_url, 
-                headers=self.headers, 
-                json=data, 
-                timeout=settings.GROQ_TIMEOUT
-            )
+        async with groq_bucket.acquire(), get_session().post(
+            self.api_url, 
+            headers=self.headers, 
+            data=orjson.dumps(data)
+        ) as response:
+            if response.status in (400, 413):
+                detail = await response.text()
+                if response.status == 413 or "context_length_exceeded" in detail:
+                    raise GroqContextLengthError(detail[:200])
             response.raise_for_status()
-            result = response.json()
-            return result['choices'][0]['message']['content']
-        except Exception as e:
-            logger.error(f"Groq API error: {str(e)}")
-            return None
+            return await response.json(loads=orjson.loads)
+    
+    @staticmethod
+    def _extract_content(result) -> Tuple[Optional[str], Optional[str]]:
+        """Return the completion text or a description of what is wrong with it"""
+        try:
+            content = result['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError):
+            return None, "відсутнє поле choices"
+        if not isinstance(content, str) or not content.strip():
+            return None, "порожня відповідь"
+        return content, None
+    
+    def _prepare_policy(self, data: dict) -> Dict:
+        """Collect the values that go into a single policy"""
+        return {
+            'passport_data': asdict(data['passport_data']) if data.get('passport_data') else {},
+            'vehicle_data': asdict(data['vehicle_data']) if data.get('vehicle_data') else {},
+            'current_date': datetime.now().strftime("%d.%m.%Y"),
+            'policy_number': f"POL-{token_hex(3).upper()}",
+        }
+    
+    @staticmethod
+    def _format_policy_details(policy: Dict) -> str:
+        """Format numbered policy details for the prompt"""
+        fields = _PolicyFields(policy, policy['passport_data'], policy['vehicle_data'])
+        return POLICY_DETAILS_TEMPLATE.format_map(fields)
     
     async def generate_insurance_policy(self, data: dict) -> str:
         """Generate insurance policy text using Groq API"""
-        passport_data = data.get('passport_data', {})
-        vehicle_data = data.get('vehicle_data', {})
+        policy = self._prepare_policy(data)
         
-        current_date = datetime.now().strftime("%d.%m.%Y")
-        policy_number = f"POL-{uuid.uuid4().hex[:6].upper()}"
+        cached = await asyncio.to_thread(load_policy, policy)
+        if cached:
+            return cached
         
-        prompt = (
-            "Створи офіційний текст страхового поліса українською мовою з наступними даними:\n"
-            f"1. Номер поліса: {policy_number}\n"
-            f"2. Дата оформлення: {current_date}\n"
-            f"3. Страхувальник: {passport_data.get('given_name', '')} {passport_data.get('surname', '')}\n"
-            f"4. Паспорт: {passport_data.get('passport_number', '')}\n"
-            f"5. Дата народження: {passport_data.get('birth_date', '')}\n"
-            f"6. Автомобіль: {vehicle_data.get('make', '')}\n"
-            f"7. Номерний знак: {vehicle_data.get('vehicle_registration_number', '')}\n"
-            f"8. VIN: {vehicle_data.get('vehicle_identification_number', '')}\n"
-            f"9. Дата реєстрації ТЗ: {vehicle_data.get('registration_date', '')}\n"
-            "10. Умови страхування: базове покриття, термін дії 1 рік, вартість 100 USD\n\n"
-            "Додай стандартні пункти страхового поліса, підпис та печатку."
+        prompt = POLICY_PROMPT_PREFIX + self._format_policy_details(policy)
+        
+        try:
+            policy_text = await self.chat_completion(
+                system=POLICY_SYSTEM_PROMPT,
+                user=prompt
+            )
+        except GroqContextLengthError as e:
+            logger.error(f"Groq prompt too large for a single policy: {e}")
+            policy_text = None
+        
+        if not policy_text:
+            return self._generate_fallback_policy(
+                policy['policy_number'], policy['current_date'],
+                policy['passport_data'], policy['vehicle_data']
+            )
+        
+        await asyncio.to_thread(store_policy, policy, policy_text)
+        return policy_text
+    
+    async def generate_insurance_policies(self, items: List[dict]) -> Optional[List[str]]:
+        """Generate several policies with one Groq request; raises GroqContextLengthError if the batch is too large"""
+        policies = [self._prepare_policy(data) for data in items]
+        texts = await asyncio.gather(
+            *(asyncio.to_thread(load_policy, policy) for policy in policies)
         )
         
-        system_prompt = (
-            "Ти - асистент з оформлення страхової документації. "
-            "Створюй офіційні, професійні тексти страхових полісів українською мовою. "
-            "Використовуй стандартні формулювання та юридично коректні терміни. "
-            "Включи всі обов'язкові реквізити страхового поліса."
+        # До моделі йдуть лише поліси, яких ще немає в кеші
+        missing = [index for index, text in enumerate(texts) if text is None]
+        if not missing:
+            return texts
+        
+        generated = await self._generate_policy_batch([policies[index] for index in missing])
+        if generated is None:
+            return None
+        
+        # Тексти зіставляються з запитами лише за позицією, тож перевіряємо, що кожен про свого страхувальника
+        mismatched = []
+        for index, text in zip(missing, generated):
+            if self._matches_policy(policies[index], text):
+                await asyncio.to_thread(store_policy, policies[index], text)
+                texts[index] = text
+            else:
+                mismatched.append(index)
+        
+        if mismatched:
+            logger.warning(f"{len(mismatched)} batched policies did not match their applicants, regenerating")
+            regenerated = await asyncio.gather(
+                *(self.generate_insurance_policy(items[index]) for index in mismatched)
+            )
+            for index, text in zip(mismatched, regenerated):
+                texts[index] = text
+        return texts
+    
+    @staticmethod
+    def _matches_policy(policy: Dict, text: str) -> bool:
+        """Check that a batched text carries its own policy number and surname"""
+        if policy['policy_number'] not in text:
+            return False
+        surname = policy['passport_data'].get('surname', '')
+        return not surname or surname.casefold() in text.casefold()
+    
+    async def _generate_policy_batch(self, policies: List[Dict]) -> Optional[List[str]]:
+        """Request several policy texts from Groq as one JSON array"""
+        prompt = (
+            POLICY_BATCH_PROMPT_PREFIX
+            + f"Кількість полісів: {len(policies)}\n\n"
+            + "\n".join(
+                f"Поліс {index}:\n{self._format_policy_details(policy)}"
+                for index, policy in enumerate(policies, start=1)
+            )
         )
         
-        policy_text = await self.chat_completion(
-            system=system_prompt,
+        content = await self.chat_completion(
+            system=POLICY_SYSTEM_PROMPT,
             user=prompt
         )
+        return self._parse_policy_list(content, len(policies))
+    
+    @staticmethod
+    def _parse_policy_list(content: Optional[str], expected: int) -> Optional[List[str]]:
+        """Extract the JSON list of policy texts from a batched completion"""
+        if not content:
+            return None
         
-        if not policy_text:
-            policy_text = self._generate_fallback_policy(policy_number, current_date, passport_data, vehicle_data)
+        start, end = content.find('['), content.rfind(']')
+        if start == -1 or end <= start:
+            return None
         
-        return policy_text
+        try:
+            texts = orjson.loads(content[start:end + 1])
+        except ValueError:
+            return None
+        
+        if not isinstance(texts, list) or len(texts) != expected:
+            return None
+        if not all(isinstance(text, str) and text.strip() for text in texts):
+            return None
+        return texts
     
     def _generate_fallback_policy(self, policy_number: str, current_date: str, 
                                 passport_data: dict, vehicle_data: dict) -> str:
         """Generate a fallback policy if Groq API fails"""
-        return (
-            f"СТРАХОВИЙ ПОЛІС №{policy_number}\n\n"
-            f"Дата оформлення: {current_date}\n\n"
-            "Страхувальник:\n"
-            f"ПІБ: {passport_data.get('given_name', '')} {passport_data.get('surname', '')}\n"
-            f"Паспорт: {passport_data.get('passport_number', '')}\n"
-            f"Дата народження: {passport_data.get('birth_date', '')}\n\n"
-            "Об'єкт страхування:\n"
-            f"Марка: {vehicle_data.get('make', '')}\n"
-            f"Номерний знак: {vehicle_data.get('vehicle_registration_number', '')}\n"
-            f"VIN: {vehicle_data.get('vehicle_identification_number', '')}\n"
-            f"Дата реєстрації: {vehicle_data.get('registration_date', '')}\n\n"
-            "Умови страхування:\n"
-            "- Вид: Автоцивілка (ОСЦПВ)\n"
-            "- Термін дії: 1 рік\n"
-            "- Сума: 100 USD\n"
-            "- Територія: Україна\n\n"
-            "Особливі умови:\n"
-            "Страхувальник зобов'язаний повідомляти про будь-які зміни.\n\n"
-            f"Дата: {current_date}\n"
-            "Підпис: ___________\n"
-            "Печатка: ___________"
-        )
\ No newline at end of file
+        fields = _PolicyFields(
+            {'policy_number': policy_number, 'current_date': current_date},
+            passport_data, vehicle_data
+        )
+        return FALLBACK_POLICY_TEMPLATE.format_map(fields)
+
+class GroqBatcher:
+    """Collects policy requests that arrive close together into one Groq call"""
+    
+    def __init__(self, service: GroqService):
+        self.service = service
+        self.window = settings.GROQ_BATCH_WINDOW
+        self.max_batch_size = settings.GROQ_BATCH_MAX_SIZE
+        self._queue: Optional[asyncio.Queue] = None
+        self._consumer: Optional[asyncio.Task] = None
+        self._batches: Set[asyncio.Task] = set()
+    
+    async def generate_insurance_policy(self, data: dict) -> str:
+        """Queue a policy request and wait for its text"""
+        if self._consumer is None or self._consumer.done():
+            self._queue = asyncio.Queue()
+            self._consumer = asyncio.create_task(self._consume())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((data, future))
+        return await future
+    
+    async def _consume(self):
+        """Group queued requests by time window and batch size"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            
+            task = asyncio.create_task(self._process(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+    
+    async def _process(self, batch: List):
+        """Generate policies for one batch and resolve the waiting futures"""
+        items = [data for data, _ in batch]
+        try:
+            texts = None
+            if len(items) > 1:
+                try:
+                    texts = await self.service.generate_insurance_policies(items)
+                except GroqContextLengthError:
+                    # Пакет не вмістився в ліміт токенів моделі - зменшуємо його розмір на 10%
+                    self.max_batch_size = max(1, int(self.max_batch_size * 0.9))
+                    logger.warning(f"Policy batch exceeded the token limit, batch size reduced to {self.max_batch_size}")
+                else:
+                    if texts is None:
+                        logger.warning("Batched policy generation failed, generating policies one by one")
+                    elif self.max_batch_size < settings.GROQ_BATCH_MAX_SIZE:
+                        # Після вдалого пакета розмір поступово повертається до налаштованого
+                        self.max_batch_size += 1
+            
+            if texts is None:
+                texts = await asyncio.gather(
+                    *(self.service.generate_insurance_policy(data) for data in items)
+                )
+            
+            for (_, future), text in zip(batch, texts):
+                if not future.done():
+                    future.set_result(text)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
@@ -1,163 +1,262 @@
-import time
-import requests
-from requests.exceptions import RequestException
+import asyncio
+import aiohttp
+import orjson
 import logging
 from typing import Optional, Dict
 from config.settings import settings
+from utils.http_utils import get_session
+from utils.rate_limit import mindee_bucket
+from services.documents import PassportData, VehicleData
+from services import mindee_webhook
 
 logger = logging.getLogger(__name__)
 
+# Заголовки авторизації однакові для всіх запитів до Mindee
+_AUTH_HEADERS = {"Authorization": f"Token {settings.MINDEE_API_KEY}"}
+
+# Спільний порожній словник для відсутніх полів, щоб не створювати новий на кожен get
+_EMPTY: Dict = {}
+
+def _extract_fields(response: Dict, fields) -> Dict[str, str]:
+    """Read prediction values for (output name, Mindee field) pairs"""
+    prediction = response.get('document', _EMPTY).get('inference', _EMPTY).get('prediction', _EMPTY)
+    get = prediction.get  # зв'язаний метод береться один раз на документ
+    values = {}
+    for name, source in fields:
+        field = get(source) or _EMPTY
+        if isinstance(field, list):
+            # Деякі моделі (напр. International ID v2) повертають список значень
+            values[name] = " ".join(item.get('value') or '' for item in field).strip()
+        else:
+            values[name] = field.get('value') or ''
+    return values
+
+class MindeeUploadError(Exception):
+    """Raised when Mindee does not accept a document for processing"""
+
+class MindeeResultError(Exception):
+    """Raised when a Mindee job fails or does not finish in time"""
+
 class MindeeBaseAPI:
     """Base class for Mindee API services"""
     
+    # Спільний для паспортів і техпаспортів ліміт одночасних запитів до Mindee
+    _concurrency = asyncio.Semaphore(settings.MINDEE_MAX_CONCURRENCY)
+    
+    # Назва документа в логах та адреси API, задаються в підкласах
+    label = "document"
+    API_URL = ""
+    QUEUE_URL_FMT = ""
+    DOCUMENT_URL_FMT = ""
+    
     def __init__(self):
         self.max_attempts = 5
         self.retry_delay = 2
         self.timeout = 30  # Спеціальний timeout для Mindee API
+        self.headers = _AUTH_HEADERS
         
-    def _make_request(self, method: str, url: str, **kwargs) -> requests.Response:
+    async def _make_request(self, method: str, url: str, files: Optional[Dict] = None,
+                            **kwargs) -> aiohttp.ClientResponse:
         """Make HTTP request with error handling and rate limit management"""
         for attempt in range(self.max_attempts):
             try:
                 # Видаляємо timeout з kwargs, якщо він там є
                 kwargs.pop('timeout', None)
-                response = requests.request(
+                if files:
+                    # FormData не можна відправити повторно, тому збираємо її на кожну спробу
+                    form = aiohttp.FormData()
+                    for name, (filename, content) in files.items():
+                        form.add_field(name, content, filename=filename)
+                    kwargs['data'] = form
+                    
+                # Семафор звільняється до очікування після 429, тож інші запити не стоять у черзі
+                async with self._concurrency, mindee_bucket.acquire(), get_session().request(
                     method, 
                     url, 
-                    timeout=self.timeout,
+                    timeout=aiohttp.ClientTimeout(total=self.timeout),
                     **kwargs
-                )
+                ) as response:
+                    await response.read()
                 
-                # Обробка 429 помилки
-                if response.status_code == 429:
+                # Обробка 429 помилки; на останній спробі помилку повертає raise_for_status
+                if response.status == 429 and attempt < self.max_attempts - 1:
                     retry_after = int(response.headers.get('Retry-After', self._calculate_backoff(attempt)))
                     logger.warning(f"Rate limited. Waiting {retry_after} seconds...")
-                    time.sleep(retry_after)
+                    await asyncio.sleep(retry_after)
                     continue
                     
                 response.raise_for_status()
                 return response
                 
-            except RequestException as e:
-                if hasattr(e, 'response') and e.response is not None and e.response.status_code == 429:
-                    retry_after = int(e.response.headers.get('Retry-After', self._calculate_backoff(attempt)))
-                    logger.warning(f"Rate limited (exception). Waiting {retry_after} seconds...")
-                    time.sleep(retry_after)
-                    continue
-                    
+            except aiohttp.ClientError as e:
                 logger.error(f"Request failed (attempt {attempt+1}): {str(e)}")
                 if attempt == self.max_attempts - 1:
                     raise
-                time.sleep(self._calculate_backoff(attempt))
+                await asyncio.sleep(self._calculate_backoff(attempt))
                 
             except Exception as e:
                 logger.error(f"Unexpected error (attempt {attempt+1}): {str(e)}")
                 if attempt == self.max_attempts - 1:
                     raise
-                time.sleep(self._calculate_backoff(attempt))
+                await asyncio.sleep(self._calculate_backoff(attempt))
     
-    def _calculate_backoff(self, attempt: int) -> float:
-        """Calculate exponential backoff time"""
-        return min(self.retry_delay * (2 ** attempt), 60)  # Максимум 60 секунд
-
-class MindeePassportAPI(MindeeBaseAPI):
-    """Service for passport document processing"""
-    
-    def __init__(self):
-        super().__init__()
-        self.api_url = "https://api.mindee.net/v1/products/Rajiole/id_card/v1/predict_async"
-        self.headers = {"Authorization": f"Token {settings.MINDEE_API_KEY}"}
-        self.retry_delay = 3
-        
-    def upload_document(self, file_path: str) -> Optional[str]:
+    async def upload_document(self, img_bytes: bytes) -> Optional[str]:
         try:
-            with open(file_path, 'rb') as f:
-                files = {'document': f}
-                response = self._make_request(
-                    'POST', 
-                    self.api_url,
-                    headers=self.headers,
-                    files=files
-                )
+            files = {'document': ('document.jpg', img_bytes)}
+            response = await self._make_request(
+                'POST', 
+                self.API_URL,
+                headers=self.headers,
+                files=files
+            )
             
-            logger.info(f"Mindee upload response: {response.text}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Mindee {self.label} upload response: {response.content_length} bytes")
             
-            if response.status_code == 202:
-                response_data = response.json()
-                if 'job' in response_data and 'id' in response_data['job']:
-                    return response_data['job']['id']
+            if response.status == 202:
+                response_data = await response.json(loads=orjson.loads)
+                job_id = response_data.get('job', {}).get('id')
+                logger.info(f"Mindee {self.label} upload status={response.status} job={job_id}")
+                if job_id:
+                    return job_id
             
-            logger.error(f"Mindee upload failed with status {response.status_code}")
+            logger.error(f"Mindee {self.label} upload failed with status {response.status}")
             return None
             
         except Exception as e:
-            logger.error(f"Exception in upload_document: {str(e)}", exc_info=True)
+            logger.error(f"Exception in {self.label} upload_document: {str(e)}", exc_info=True)
             return None
     
-    def get_result(self, job_id: str) -> Optional[Dict]:
+    async def get_result(self, job_id: str) -> Optional[Dict]:
         if not job_id:
             return None
             
-        url = f"https://api.mindee.net/v1/products/Rajiole/id_card/v1/documents/queue/{job_id}"
+        if not mindee_webhook.is_enabled():
+            return await self._poll_result(job_id, settings.MINDEE_POLL_INTERVAL)
         
-        for attempt in range(self.max_attempts):
+        # Webhook і рідше опитування змагаються: якщо webhook не налаштований у Mindee,
+        # результат все одно прийде через опитування без очікування повного таймауту
+        pushed = asyncio.create_task(mindee_webhook.wait_for_result(job_id, settings.MINDEE_WEBHOOK_TIMEOUT))
+        polled = asyncio.create_task(self._poll_result(job_id, settings.MINDEE_WEBHOOK_POLL_INTERVAL))
+        pending = {pushed, polled}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if polled in done:
+                    return polled.result()
+                if pushed in done and pushed.result() is not None:
+                    return await self._completed_result(pushed.result())
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+    
+    async def _poll_result(self, job_id: str, interval: float) -> Optional[Dict]:
+        """Poll the job queue until the job finishes or attempts run out"""
+        url = self.QUEUE_URL_FMT.format(job_id)
+        
+        # Значення, що використовуються на кожній ітерації опитування
+        max_attempts = settings.MINDEE_MAX_ATTEMPTS
+        headers = self.headers
+        
+        for attempt in range(max_attempts):
             try:
-                response = self._make_request('GET', url, headers=self.headers)
-                data = response.json()
+                response = await self._make_request('GET', url, headers=headers)
+                data = await response.json(loads=orjson.loads)
                 
-                logger.info(f"Mindee status check attempt {attempt+1}")
+                logger.info(f"Mindee {self.label} status check attempt {attempt+1} "
+                            f"(request id {response.headers.get('X-Request-Id')})")
                 
-                if data.get('job', {}).get('status') == "completed":
-                    if 'document' in data and 'id' in data['document']:
-                        document_id = data['document']['id']
-                        return self._get_document_data(document_id)
-                    return data
-                elif data.get('job', {}).get('status') == "failed":
-                    logger.error(f"Mindee processing failed: {data}")
-                    return None
+                if data.get('job', {}).get('status') in ("completed", "failed"):
+                    return await self._completed_result(data)
                     
-                time.sleep(self._calculate_backoff(attempt))
+                await asyncio.sleep(self._poll_delay(attempt, interval, response))
             except Exception as e:
-                logger.error(f"Error checking status (attempt {attempt+1}): {str(e)}")
-                if attempt == self.max_attempts - 1:
+                logger.error(f"Error checking {self.label} status (attempt {attempt+1}): {str(e)}")
+                if attempt == max_attempts - 1:
                     return None
-                time.sleep(self._calculate_backoff(attempt))
+                await asyncio.sleep(self._poll_delay(attempt, interval))
         
-        logger.error(f"Max attempts reached for job {job_id}")
+        logger.error(f"Max attempts reached for {self.label} job {job_id}")
         return None
     
-    def _get_document_data(self, document_id: str) -> Optional[Dict]:
-        url = f"https://api.mindee.net/v1/products/Rajiole/id_card/v1/documents/{document_id}"
+    async def _completed_result(self, data: Dict) -> Optional[Dict]:
+        """Turn a finished job payload (polled or pushed) into the document response"""
+        if data.get('job', {}).get('status') == "failed":
+            logger.error(f"Mindee {self.label} processing failed: {data}")
+            return None
+        document = data.get('document', {})
+        if 'inference' in document:
+            return data
+        if 'id' in document:
+            return await self.get_document_data(document['id'])
+        return data
+    
+    async def get_document_data(self, document_id: str) -> Optional[Dict]:
+        url = self.DOCUMENT_URL_FMT.format(document_id)
         
         try:
-            response = self._make_request('GET', url, headers=self.headers)
-            return response.json()
+            response = await self._make_request('GET', url, headers=self.headers)
+            return await response.json(loads=orjson.loads)
         except Exception as e:
-            logger.error(f"Error getting document data: {str(e)}")
+            logger.error(f"Error getting {self.label} document data: {str(e)}")
             return None
     
-    @staticmethod
-    def extract_passport_data(response: Dict) -> Optional[Dict]:
+    async def process_document(self, img_bytes: bytes) -> Dict:
+        """Upload a document and wait for its prediction in one call"""
+        job_id = await self.upload_document(img_bytes)
+        if not job_id:
+            raise MindeeUploadError(f"Mindee {self.label} upload failed")
+        result = await self.get_result(job_id)
+        if result is None:
+            raise MindeeResultError(f"Mindee {self.label} job {job_id} failed or timed out")
+        return result
+    
+    def _poll_delay(self, attempt: int, interval: float,
+                    response: Optional[aiohttp.ClientResponse] = None) -> float:
+        """Delay before the next status check: geometric growth, honouring Retry-After"""
+        retry_after = 0.0
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get('Retry-After', 0))
+            except ValueError:
+                pass
+        delay = max(retry_after, interval * 1.5 ** attempt)
+        return min(delay, settings.MINDEE_POLL_MAX_DELAY)
+    
+    def _calculate_backoff(self, attempt: int) -> float:
+        """Calculate exponential backoff time"""
+        return min(self.retry_delay * (2 ** attempt), 60)  # Максимум 60 секунд
+
+class MindeePassportAPI(MindeeBaseAPI):
+    """Service for passport document processing"""
+    
+    label = "passport"
+    API_URL = "https://api.mindee.net/v1/products/Rajiole/id_card/v1/predict_async"
+    QUEUE_URL_FMT = "https://api.mindee.net/v1/products/Rajiole/id_card/v1/documents/queue/{}"
+    DOCUMENT_URL_FMT = "https://api.mindee.net/v1/products/Rajiole/id_card/v1/documents/{}"
+    
+    # Поле PassportData -> поле прогнозу Mindee
+    _FIELDS = (
+        ('surname', 'surnames'),
+        ('given_name', 'given_names'),
+        ('passport_number', 'document_number'),
+        ('nationality', 'nationality'),
+        ('birth_date', 'birth_date'),
+    )
+    
+    def __init__(self):
+        super().__init__()
+        self.retry_delay = 3
+    
+    @classmethod
+    def extract_passport_data(cls, response: Dict) -> Optional[PassportData]:
         if not response:
             return None
             
         try:
-            prediction = response.get('document', {}).get('inference', {}).get('prediction', {})
-            
-            return {
-                'document_type': prediction.get('document_type', {}).get('value'),
-                'document_number': prediction.get('document_number', {}).get('value'),
-                'surname': prediction.get('surnames', {}).get('value'),
-                'given_name': prediction.get('given_names', {}).get('value'),
-                'sex': prediction.get('sex', {}).get('value'),
-                'birth_date': prediction.get('birth_date', {}).get('value'),
-                'nationality': prediction.get('nationality', {}).get('value'),
-                'personal_number': prediction.get('personal_number', {}).get('value'),
-                'country_of_issue': prediction.get('country_of_issue', {}).get('value'),
-                'issue_date': prediction.get('issue_date', {}).get('value'),
-                'expiration_date': prediction.get('expiration_date', {}).get('value'),
-                'tech_passport': None
-            }
+            return PassportData(**_extract_fields(response, cls._FIELDS))
         except Exception as e:
             logger.error(f"Error parsing data: {e}", exc_info=True)
             return None
@@ -165,96 +264,27 @@ class MindeePassportAPI(MindeeBaseAPI):
 class MindeeVehicleAPI(MindeeBaseAPI):
     """Service for vehicle document processing"""
     
-    def __init__(self):
-        super().__init__()
-        self.api_url = "https://api.mindee.net/v1/products/Rajiole/vehicle_registration_certificates/v1/predict_async"
-        self.headers = {"Authorization": f"Token {settings.MINDEE_API_KEY}"}
-        
-    def upload_document(self, file_path: str) -> Optional[str]:
-        try:
-            with open(file_path, 'rb') as f:
-                files = {'document': f}
-                response = self._make_request(
-                    'POST', 
-                    self.api_url,
-                    headers=self.headers,
-                    files=files
-                )
-            
-            logger.info(f"Mindee vehicle upload response: {response.text}")
-            
-            if response.status_code == 202:
-                response_data = response.json()
-                if 'job' in response_data and 'id' in response_data['job']:
-                    return response_data['job']['id']
-            
-            logger.error(f"Mindee vehicle upload failed with status {response.status_code}")
-            return None
-            
-        except Exception as e:
-            logger.error(f"Exception in upload_vehicle_document: {str(e)}", exc_info=True)
-            return None
+    label = "vehicle"
+    API_URL = "https://api.mindee.net/v1/products/Rajiole/vehicle_registration_certificates/v1/predict_async"
+    QUEUE_URL_FMT = "https://api.mindee.net/v1/products/Rajiole/vehicle_registration_certificates/v1/documents/queue/{}"
+    DOCUMENT_URL_FMT = "https://api.mindee.net/v1/products/Rajiole/vehicle_registration_certificates/v1/documents/{}"
     
-    def get_result(self, job_id: str) -> Optional[Dict]:
-        if not job_id:
-            return None
-            
-        url = f"https://api.mindee.net/v1/products/Rajiole/vehicle_registration_certificates/v1/documents/queue/{job_id}"
-        
-        for attempt in range(self.max_attempts):
-            try:
-                response = self._make_request('GET', url, headers=self.headers)
-                data = response.json()
-                
-                logger.info(f"Mindee vehicle status check attempt {attempt+1}")
-                
-                if data.get('job', {}).get('status') == "completed":
-                    if 'document' in data and 'id' in data['document']:
-                        document_id = data['document']['id']
-                        return self.get_document_data(document_id)
-                    return data
-                elif data.get('job', {}).get('status') == "failed":
-                    logger.error(f"Mindee vehicle processing failed: {data}")
-                    return None
-                    
-                time.sleep(self._calculate_backoff(attempt))
-            except Exception as e:
-                logger.error(f"Error checking vehicle status (attempt {attempt+1}): {str(e)}")
-                if attempt == self.max_attempts - 1:
-                    return None
-                time.sleep(self._calculate_backoff(attempt))
-        
-        logger.error(f"Max attempts reached for vehicle job {job_id}")
-        return None
-    
-    def get_document_data(self, document_id: str) -> Optional[Dict]:
-        url = f"https://api.mindee.net/v1/products/Rajiole/vehicle_registration_certificates/v1/documents/{document_id}"
-        
-        try:
-            response = self._make_request('GET', url, headers=self.headers)
-            return response.json()
-        except Exception as e:
-            logger.error(f"Error getting vehicle document data: {str(e)}")
-            return None
+    # Поле VehicleData -> поле прогнозу Mindee
+    _FIELDS = (
+        ('vehicle_registration_number', 'vehicle_registration_number'),
+        ('registration_date', 'registration_date'),
+        ('owner_name', 'owner_name'),
+        ('vehicle_identification_number', 'vehicle_identification_number'),
+        ('make', 'make'),
+    )
     
-    @staticmethod
-    def extract_vehicle_data(response: Dict) -> Optional[Dict]:
+    @classmethod
+    def extract_vehicle_data(cls, response: Dict) -> Optional[VehicleData]:
         if not response:
             return None
             
         try:
-            prediction = response.get('document', {}).get('inference', {}).get('prediction', {})
-            
-            vehicle_data = {
-                'vehicle_registration_number': prediction.get('vehicle_registration_number', {}).get('value', None),
-                'registration_date': prediction.get('registration_date', {}).get('value', None),
-                'owner_name': prediction.get('owner_name', {}).get('value', None),
-                'vehicle_identification_number': prediction.get('vehicle_identification_number', {}).get('value', None),
-                'make': prediction.get('make', {}).get('value', None),
-                'insurance_details': prediction.get('insurance_details', [])
-            }
-            
-            return {k: v for k, v in vehicle_data.items() if v is not None}
+            return VehicleData(**_extract_fields(response, cls._FIELDS))
         except Exception as e:
             logger.error(f"Error parsing vehicle data: {e}", exc_info=True)
-            return None
\ No newline at end of file
+            return None
@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import orjson
+import time
+from typing import Dict, Optional, Tuple
+from aiohttp import web
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Очікувачі результатів: job_id -> future, що завершується webhook-викликом Mindee
+_waiters: Dict[str, asyncio.Future] = {}
+# Результати, що надійшли раніше, ніж get_result почав чекати: job_id -> (час отримання, payload).
+# Містять паспортні дані, тому живуть не довше за MINDEE_WEBHOOK_TIMEOUT
+_early_results: Dict[str, Tuple[float, Dict]] = {}
+_MAX_EARLY_RESULTS = 1000
+# Задачі, очікування яких вже завершилось (результат, таймаут або перемога опитування):
+# job_id -> час завершення. Пізні виклики для них відкидаються
+_finished: Dict[str, float] = {}
+
+_runner: Optional[web.AppRunner] = None
+
+def is_enabled() -> bool:
+    """Webhook delivery is used only when a listener port and a signing secret are configured"""
+    return bool(settings.MINDEE_WEBHOOK_PORT and settings.MINDEE_WEBHOOK_SECRET)
+
+def purge_expired():
+    """Drop early results and finished-job marks older than MINDEE_WEBHOOK_TIMEOUT"""
+    cutoff = time.monotonic() - settings.MINDEE_WEBHOOK_TIMEOUT
+    for job_id in [job_id for job_id, (received_at, _) in _early_results.items() if received_at < cutoff]:
+        del _early_results[job_id]
+    for job_id in [job_id for job_id, finished_at in _finished.items() if finished_at < cutoff]:
+        del _finished[job_id]
+
+async def wait_for_result(job_id: str, timeout: float) -> Optional[Dict]:
+    """Wait for Mindee to push the finished job, or return None on timeout"""
+    purge_expired()
+    if job_id in _early_results:
+        _finished[job_id] = time.monotonic()
+        return _early_results.pop(job_id)[1]
+
+    future = asyncio.get_running_loop().create_future()
+    _waiters[job_id] = future
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"No Mindee webhook for job {job_id} within {timeout}s, falling back to polling")
+        return None
+    finally:
+        _waiters.pop(job_id, None)
+        _finished[job_id] = time.monotonic()
+
+def _valid_signature(body: bytes, signature: str) -> bool:
+    """Check the HMAC-SHA256 signature Mindee computes over the raw body"""
+    expected = hmac.new(settings.MINDEE_WEBHOOK_SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected.encode(), signature.strip().lower().encode("utf-8", "replace"))
+
+async def _handle_callback(request: web.Request) -> web.Response:
+    """Resolve the waiting get_result call with the pushed prediction"""
+    body = await request.read()
+    if not _valid_signature(body, request.headers.get(settings.MINDEE_WEBHOOK_SIGNATURE_HEADER, "")):
+        logger.warning(f"Rejected Mindee webhook call with invalid signature from {request.remote}")
+        return web.Response(status=401)
+
+    try:
+        payload = orjson.loads(body)
+        job_id = payload['job']['id']
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+
+    purge_expired()
+    future = _waiters.get(job_id)
+    if future is not None and not future.done():
+        future.set_result(payload)
+    elif job_id in _finished:
+        # Очікування вже завершилось (наприклад, результат отримано опитуванням) - дані не зберігаємо
+        logger.debug(f"Discarding late Mindee webhook for job {job_id}")
+    else:
+        if len(_early_results) >= _MAX_EARLY_RESULTS:
+            _early_results.pop(next(iter(_early_results)))
+        _early_results[job_id] = (time.monotonic(), payload)
+    return web.Response(status=200)
+
+async def start_server():
+    """Start the HTTP listener that receives Mindee job notifications"""
+    global _runner
+    app = web.Application()
+    app.router.add_post(settings.MINDEE_WEBHOOK_PATH, _handle_callback)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, settings.MINDEE_WEBHOOK_HOST, int(settings.MINDEE_WEBHOOK_PORT)).start()
+    logger.info(f"Mindee webhook listening on {settings.MINDEE_WEBHOOK_HOST}:{settings.MINDEE_WEBHOOK_PORT}"
+                f"{settings.MINDEE_WEBHOOK_PATH}")
+
+async def stop_server():
+    """Stop the webhook listener if it was started"""
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
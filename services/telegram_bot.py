@@ -1,11 +1,69 @@
-from telegram.ext import ApplicationBuilder
+import asyncio
+import orjson
+from urllib.parse import urlparse
+from telegram.ext import Application, ApplicationBuilder, ContextTypes, PicklePersistence
+from telegram.request import HTTPXRequest
 from config.settings import settings
+from utils.http_utils import close_session, get_session
+from services import mindee_webhook
+from utils.ocr_cache import purge_expired_disk_entries
+from utils.policy_cache import purge_expired_policies
+
+class OrjsonRequest(HTTPXRequest):
+    """HTTPX request backend that decodes Bot API responses with orjson"""
+    
+    @staticmethod
+    def parse_json_payload(payload: bytes):
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # Некоректний UTF-8 чи JSON обробляє стандартний розбір PTB
+            return HTTPXRequest.parse_json_payload(payload)
 
 class TelegramBot:
     """Main Telegram bot application"""
     
     def __init__(self):
-        self.application = ApplicationBuilder().token(settings.TELEGRAM_TOKEN).build()
+        persistence = PicklePersistence(filepath=settings.PERSISTENCE_FILE)
+        builder = (
+            ApplicationBuilder()
+            .token(settings.TELEGRAM_TOKEN)
+            .persistence(persistence)
+            # Bot API connection pool sized for concurrent replies to many users
+            .request(OrjsonRequest(
+                connection_pool_size=settings.TELEGRAM_POOL_SIZE,
+                pool_timeout=settings.TELEGRAM_POOL_TIMEOUT,
+                connect_timeout=settings.TELEGRAM_CONNECT_TIMEOUT,
+                read_timeout=settings.TELEGRAM_READ_TIMEOUT,
+            ))
+            .get_updates_request(OrjsonRequest())
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+        )
+        if settings.TELEGRAM_BASE_URL:
+            builder = builder.base_url(settings.TELEGRAM_BASE_URL)
+        if settings.TELEGRAM_BASE_FILE_URL:
+            builder = builder.base_file_url(settings.TELEGRAM_BASE_FILE_URL)
+        self.application = builder.build()
+    
+    async def _post_init(self, application: Application):
+        """Open the shared HTTP session and the optional Mindee webhook listener"""
+        get_session()
+        if mindee_webhook.is_enabled():
+            await mindee_webhook.start_server()
+        # Прострочені кеші з персональними даними видаляються й без звернень до них
+        application.job_queue.run_repeating(self._purge_caches, interval=settings.CACHE_PURGE_INTERVAL, first=0)
+    
+    async def _purge_caches(self, context: ContextTypes.DEFAULT_TYPE):
+        """Remove expired cached documents and policies"""
+        await asyncio.to_thread(purge_expired_policies)
+        await asyncio.to_thread(purge_expired_disk_entries)
+        mindee_webhook.purge_expired()
+    
+    async def _post_shutdown(self, application: Application):
+        """Release shared HTTP connections after the bot stops"""
+        await mindee_webhook.stop_server()
+        await close_session()
     
     def setup_handlers(self, handlers):
         """Add all conversation handlers to the application"""
@@ -14,4 +72,14 @@ class TelegramBot:
     
     def run(self):
         """Start the bot"""
-        self.application.run_polling()
\ No newline at end of file
+        if settings.WEBHOOK_URL:
+            # Telegram надсилає оновлення сам, без порожніх запитів getUpdates
+            self.application.run_webhook(
+                listen=settings.WEBHOOK_LISTEN,
+                port=settings.WEBHOOK_PORT,
+                url_path=urlparse(settings.WEBHOOK_URL).path.lstrip("/"),
+                webhook_url=settings.WEBHOOK_URL,
+                secret_token=settings.WEBHOOK_SECRET,
+            )
+        else:
+            self.application.run_polling(timeout=settings.POLLING_TIMEOUT, poll_interval=0.0)
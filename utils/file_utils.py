@@ -1,28 +1,88 @@
+import hashlib
 import os
-import json
-import uuid
-from datetime import datetime
+import tempfile
+import time
+from datetime import date
+from secrets import token_hex
+import orjson
+from pathlib import Path
 from typing import Optional
 from config.settings import settings
+from services.documents import PassportData
 from utils.logging_utils import logger
 
+# Каталоги створюються один раз за процес
+_dirs_ready = False
+
 def ensure_directories_exist():
     """Create necessary directories if they don't exist"""
-    os.makedirs(settings.DOWNLOADS_DIR, exist_ok=True)
-    os.makedirs(settings.MINDEE_DATA_DIR, exist_ok=True)
+    global _dirs_ready
+    if _dirs_ready:
+        return
+    # Створюємо лише кінцеві каталоги; спільні батьківські з'являться разом з ними
+    mindee_dir = Path(settings.MINDEE_DATA_DIR)
+    for directory in (mindee_dir / "by-hash", mindee_dir / "documents",
+                      Path(settings.GROQ_CACHE_DIR), Path(settings.MINDEE_CACHE_DIR)):
+        directory.mkdir(parents=True, exist_ok=True)
+    _dirs_ready = True
+
+def atomic_write(path: str, data: bytes):
+    """Write a file via a temporary file and os.replace so readers never see partial content"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
-def save_mindee_response(job_id: str, response: dict) -> Optional[str]:
-    """Save Mindee API response to a file"""
+def purge_expired_files(directory: str, ttl: float) -> int:
+    """Delete files in a cache directory that were last written more than ttl seconds ago"""
+    removed = 0
+    cutoff = time.time() - ttl
     try:
-        filename = f"{settings.MINDEE_DATA_DIR}/mindee_response_{job_id}.json"
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(response, f, ensure_ascii=False, indent=4)
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_file() and entry.stat().st_mtime <= cutoff:
+                os.unlink(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Error purging {entry.path}: {e}")
+    return removed
+
+def save_mindee_response(document_id: str, response: dict) -> Optional[str]:
+    """Save Mindee API response once per content hash and link it under the document id"""
+    try:
+        encoded = orjson.dumps(
+            response,
+            option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+        )
+        digest = hashlib.blake2b(encoded, digest_size=16).hexdigest()
+        filename = os.path.join(settings.MINDEE_DATA_DIR, "by-hash", f"{digest}.json")
+        if not os.path.exists(filename):
+            atomic_write(filename, encoded)
+
+        link = os.path.join(settings.MINDEE_DATA_DIR, "documents", f"{document_id}.json")
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        try:
+            os.link(filename, link)
+        except FileExistsError:
+            pass
         return filename
     except Exception as e:
         logger.error(f"Error saving JSON: {e}")
         return None
 
-def generate_policy_filename(passport_data: dict) -> str:
+def generate_policy_filename(passport_data: PassportData) -> str:
     """Generate filename for insurance policy"""
-    name = f"{passport_data.get('given_name', '')}_{passport_data.get('surname', '')}".strip()
-    return f"insurance_{name}_{datetime.now().strftime('%Y%m%d')}.txt"
\ No newline at end of file
+    name = f"{passport_data.given_name}_{passport_data.surname}".strip("_")
+    # Дата й короткий суфікс, щоб повторно виданий поліс не мав того ж імені
+    return f"Страховий_поліс_{name}_{date.today():%Y%m%d}_{token_hex(3)}.txt"
\ No newline at end of file
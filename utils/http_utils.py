@@ -0,0 +1,28 @@
+import aiohttp
+from typing import Optional
+from config.settings import settings
+
+_session: Optional[aiohttp.ClientSession] = None
+
+def get_session() -> aiohttp.ClientSession:
+    """Return the shared aiohttp session, creating it on first use"""
+    global _session
+    if _session is None or _session.closed:
+        # Keep-alive пул спільний для Mindee та Groq: з'єднання перевикористовуються між запитами
+        connector = aiohttp.TCPConnector(
+            limit=settings.HTTP_POOL_LIMIT,
+            limit_per_host=settings.HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=settings.GROQ_TIMEOUT)
+        )
+    return _session
+
+async def close_session():
+    """Close the shared aiohttp session if it was opened"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+import os
+import orjson
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from config.settings import settings
+from utils.file_utils import atomic_write, purge_expired_files
+from utils.logging_utils import logger
+
+# Розпізнані дані документів: ключ -> (час збереження, JSON)
+_cache: Dict[str, Tuple[float, bytes]] = {}
+# Розпізнавання, що вже виконуються: ключ -> задача
+_inflight: Dict[str, asyncio.Task] = {}
+
+def make_cache_key(img_bytes: bytes, key_prefix: str) -> str:
+    """Build cache key from the image content hash"""
+    return f"{key_prefix}:{hashlib.blake2b(img_bytes, digest_size=16).hexdigest()}"
+
+def _purge_expired(now: float):
+    """Drop entries older than OCR_CACHE_TTL"""
+    expired = [key for key, (stored_at, _) in _cache.items() if now - stored_at >= settings.OCR_CACHE_TTL]
+    for key in expired:
+        del _cache[key]
+
+def _disk_path(key: str) -> str:
+    """Map a cache key to its file in MINDEE_CACHE_DIR"""
+    return os.path.join(settings.MINDEE_CACHE_DIR, f"{key.replace(':', '_')}.json")
+
+def _read_disk(key: str) -> Optional[bytes]:
+    """Read a disk cache entry, deleting it if it is older than MINDEE_CACHE_TTL"""
+    path = _disk_path(key)
+    try:
+        if time.time() - os.stat(path).st_mtime >= settings.MINDEE_CACHE_TTL:
+            os.unlink(path)
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.error(f"Error reading OCR cache: {e}")
+        return None
+
+def _write_disk(key: str, encoded: bytes):
+    """Persist a cache entry so it survives bot restarts"""
+    try:
+        atomic_write(_disk_path(key), encoded)
+    except OSError as e:
+        logger.error(f"Error writing OCR cache: {e}")
+
+def purge_expired_disk_entries():
+    """Delete disk cache entries older than MINDEE_CACHE_TTL"""
+    removed = purge_expired_files(settings.MINDEE_CACHE_DIR, settings.MINDEE_CACHE_TTL)
+    if removed:
+        logger.info(f"Purged {removed} expired OCR cache files")
+
+async def _compute_and_store(key: str, compute_coro: Callable[[], Awaitable[Any]]) -> Optional[bytes]:
+    """Run OCR once and cache the result (dict or dataclass) as JSON"""
+    # Другий рівень кешу на диску: повторне фото після перезапуску не йде в Mindee
+    encoded = await asyncio.to_thread(_read_disk, key)
+    if encoded:
+        logger.info(f"OCR disk cache hit for {key}")
+    else:
+        result = await compute_coro()
+        if not result:
+            return None
+        encoded = orjson.dumps(result)
+        await asyncio.to_thread(_write_disk, key, encoded)
+
+    now = time.monotonic()
+    _purge_expired(now)
+    _cache[key] = (now, encoded)
+    return encoded
+
+async def get_or_compute(img_bytes: bytes, key_prefix: str,
+                         compute_coro: Callable[[], Awaitable[Any]]) -> Optional[Dict]:
+    """Return cached OCR data for the image or compute and cache it"""
+    key = make_cache_key(img_bytes, key_prefix)
+
+    cached = _cache.get(key)
+    if cached and time.monotonic() - cached[0] < settings.OCR_CACHE_TTL:
+        logger.info(f"OCR cache hit for {key}")
+        return orjson.loads(cached[1])
+
+    # Однакові фото, що надійшли одночасно, розпізнаються одним запитом
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_compute_and_store(key, compute_coro))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        logger.info(f"Joining in-flight OCR for {key}")
+
+    # shield: скасування одного з очікувачів не перериває спільне розпізнавання
+    encoded = await asyncio.shield(task)
+    return orjson.loads(encoded) if encoded else None
@@ -0,0 +1,61 @@
+import hashlib
+import os
+import time
+import orjson
+from typing import Optional
+from config.settings import settings
+from utils.file_utils import atomic_write, purge_expired_files
+from utils.logging_utils import logger
+
+# Змінюється разом із текстом промпту, щоб старі відповіді не перевикористовувались
+POLICY_PROMPT_VERSION = 2
+
+# Номер поліса унікальний для кожного оформлення, тому в кеші замість нього маркер.
+# Дата входить у ключ: похідні від неї дати (кінець дії тощо) не можна підставити маркером
+POLICY_NUMBER_MARKER = "<<POLICY_NUMBER>>"
+
+def _cache_path(policy: dict) -> str:
+    """Build the cache file path from the normalized policy input"""
+    payload = orjson.dumps({
+        "model": settings.GROQ_MODEL,
+        "p": policy['passport_data'],
+        "v": policy['vehicle_data'],
+        "date": policy['current_date'],
+        "prompt_v": POLICY_PROMPT_VERSION,
+    }, option=orjson.OPT_SORT_KEYS)
+    key = hashlib.sha256(payload).hexdigest()
+    return os.path.join(settings.GROQ_CACHE_DIR, f"{key}.txt")
+
+def load_policy(policy: dict) -> Optional[str]:
+    """Return the cached policy text with this policy's number"""
+    path = _cache_path(policy)
+    try:
+        if time.time() - os.stat(path).st_mtime >= settings.POLICY_CACHE_TTL:
+            # Паспортні дані не зберігаються довше за TTL
+            os.unlink(path)
+            return None
+        with open(path, encoding="utf-8") as f:
+            skeleton = f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.error(f"Error reading policy cache: {e}")
+        return None
+
+    logger.info(f"Policy cache hit for {os.path.basename(path)}")
+    return skeleton.replace(POLICY_NUMBER_MARKER, policy['policy_number'])
+
+def store_policy(policy: dict, text: str):
+    """Cache the generated policy text, replacing its number with a marker"""
+    skeleton = text.replace(policy['policy_number'], POLICY_NUMBER_MARKER)
+    path = _cache_path(policy)
+    try:
+        atomic_write(path, skeleton.encode("utf-8"))
+    except OSError as e:
+        logger.error(f"Error writing policy cache: {e}")
+
+def purge_expired_policies():
+    """Delete cached policies older than POLICY_CACHE_TTL"""
+    removed = purge_expired_files(settings.GROQ_CACHE_DIR, settings.POLICY_CACHE_TTL)
+    if removed:
+        logger.info(f"Purged {removed} expired cached policies")
@@ -0,0 +1,38 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from config.settings import settings
+
+class AsyncTokenBucket:
+    """Token bucket shared by all coroutines calling the same API"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate  # токенів за секунду
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def wait(self):
+        """Wait until a token is available and take it"""
+        # Lock зберігає порядок черги, тож запити отримують токени по черзі
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Context manager form of wait()"""
+        await self.wait()
+        yield
+
+mindee_bucket = AsyncTokenBucket(rate=settings.MINDEE_QPS, capacity=settings.MINDEE_QPS)
+groq_bucket = AsyncTokenBucket(rate=settings.GROQ_RPM / 60, capacity=settings.GROQ_RPM)